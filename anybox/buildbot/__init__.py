@@ -1,6 +1,3 @@
-# See http://peak.telecommunity.com/DevCenter/setuptools#namespace-packages
-try:
-    __import__('pkg_resources').declare_namespace(__name__)
-except ImportError:
-    from pkgutil import extend_path
-    __path__ = extend_path(__path__, __name__)
+# pkgutil-style namespace package, see
+# https://packaging.python.org/guides/packaging-namespace-packages/
+__path__ = __import__('pkgutil').extend_path(__path__, __name__)
@@ -13,3 +13,5 @@
 # this program; if not, If not, see <http://www.gnu.org/licenses/>.
 #
 # Copyright Georges Racinet <gracinet@anybox.fr>
+
+from ._version import __version__  # NOQA
@@ -0,0 +1,19 @@
+# This file is part of anybox.buildbot.capability.
+# anybox.buildbot.capability is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright Georges Racinet <gracinet@anybox.fr>
+
+# Single source for the version number; read without importing the package
+# by setup.py and the Sphinx configuration.
+__version__ = '0.2'
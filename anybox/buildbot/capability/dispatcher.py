@@ -17,11 +17,13 @@
 """Core functionnality to manipulate capabilities."""
 
 import re
-from copy import deepcopy
+from collections import namedtuple
+from functools import partial
 
 from buildbot.plugins import util
 
-from .version import Version
+from .version import intern_string
+from .version import parse_version
 from .steps import SetCapabilityProperties
 from .constants import CAPABILITY_PROP_FMT
 
@@ -31,6 +33,42 @@ Interpolate = util.Interpolate
 _missing_cap = object()
 
 
+_interpolations = {}
+
+
+def interpolate(template):
+    """Return an :class:`Interpolate` instance for the given template.
+
+    Instances are shared for identical templates, as they are immutable
+    as far as this package is concerned.
+    """
+    interpolation = _interpolations.get(template)
+    if interpolation is None:
+        interpolation = _interpolations[template] = Interpolate(template)
+    return interpolation
+
+
+def _criteria_weight(cap_vf):
+    """Rough estimate of how restrictive a version filter is by itself.
+
+    The lower, the more restrictive: equality, then other comparisons,
+    then boolean combinations, then absence of criteria.
+    """
+    if not cap_vf.criteria:
+        return 3
+    op = cap_vf.criteria[0]
+    if op == '==':
+        return 0
+    if op.upper() in ('AND', 'OR'):
+        return 2
+    return 1
+
+
+def _cap_opt_to_prop(cap_name, match):
+    """Substitution callback turning ``cap(<option>)`` into a property ref."""
+    return 'prop:' + CAPABILITY_PROP_FMT % (cap_name, match.group(1))
+
+
 def does_meet_requirements(caps, requirements):
     """True if a worker capabilities fulfills all requirements.
 
@@ -48,13 +86,17 @@ def does_meet_requirements(caps, requirements):
                 continue
             return False
         for version in version_options:
-            if req.match(Version.parse(version)):
+            if req.match(parse_version(version)):
                 break
         else:
             return False
     return True
 
 
+CompiledCapabilities = namedtuple('CompiledCapabilities',
+                                  ('environ', 'abbrev'))
+
+
 class BuilderDispatcher(object):
     """Provide the means to spawn builders according to capability settings.
 
@@ -80,11 +122,119 @@ class BuilderDispatcher(object):
                                     },
                            ))
 
+    What can be derived from ``capabilities`` alone is prepared by the
+    :meth:`compile_capabilities` class method. Its result can be passed as
+    ``compiled`` to share it among several dispatchers for the same
+    capabilities.
     """
-    def __init__(self, workers, capabilities):
+    def __init__(self, workers, capabilities, compiled=None):
         self.all_workers = dict((worker.workername, worker)
                                 for worker in workers)
         self.capabilities = capabilities
+        if compiled is None:
+            compiled = self.compile_capabilities(capabilities)
+        self._environ = compiled.environ
+        self._abbrev = compiled.abbrev
+        self.invalidate()
+
+    @classmethod
+    def compile_capabilities(cls, capabilities):
+        """Prepare the capabilities description for dispatching and builds.
+
+        The ``cap(<option>)`` substitutions in ``environ`` and the
+        :class:`Interpolate` instantiations are done once and for all, the
+        resulting instances being shared by all factories (and by all
+        dispatchers, see :func:`interpolate`).
+
+        :returns: a :class:`CompiledCapabilities` instance, whose
+                  ``environ`` :class:`dict` maps capability names to
+                  :class:`dict` instances mapping environment variable names
+                  to :class:`Interpolate` instances, and ``abbrev`` maps
+                  capability names to the abbreviation to use in builder
+                  names.
+        """
+        environ = {}
+        for cap_name, capability in capabilities.items():
+            replace = partial(_cap_opt_to_prop, cap_name)
+            environ[cap_name] = dict(
+                (env_key,
+                 interpolate(RE_PROP_CAP_OPT.sub(replace, interpolation)))
+                for env_key, interpolation in (
+                    capability.get('environ') or {}).items())
+        return CompiledCapabilities(
+            environ=environ,
+            abbrev=dict((cap_name, capability.get('abbrev', cap_name))
+                        for cap_name, capability in capabilities.items()))
+
+    def invalidate(self):
+        """Reset all indexes and caches about workers.
+
+        They are computed from :attr:`all_workers` at instantiation, and
+        filled as builders get made. This must be called if
+        :attr:`all_workers` or the properties of the workers change
+        afterwards.
+        """
+        self._worker_caps = dict(
+            (workername, worker.properties['capability'])
+            for workername, worker in self.all_workers.items())
+        self._matches = {}
+        self._workers_matching = {}
+        self._only_if_requires = {}
+        (self._workers_by_cap_version,
+         self._workers_with_cap,
+         self._workers_without_versions) = self.index_workers_by_capability()
+
+    def version_matches(self, cap_vf, version):
+        """Memoized matching of a capability version string against a filter.
+
+        :param cap_vf: a :class:`VersionFilter` instance
+        :param version: a version string, as found in workers capabilities,
+                        or ``None``
+        """
+        key = (cap_vf, version)
+        matches = self._matches.get(key)
+        if matches is None:
+            matches = self._matches[key] = cap_vf.match(
+                parse_version(version))
+        return matches
+
+    def index_workers_by_capability(self):
+        """Scan all workers once to map capabilities to holding workers.
+
+        :returns: a triple of :class:`dict` instances whose keys are
+                  capability names. In the first one, values are flat
+                  tuples of pairs made of each available version of
+                  the capability and the :class:`frozenset` of names of
+                  workers having it. Indeed, the dispatcher only iterates
+                  over them.
+                  In the second one, values are the :class:`frozenset` of
+                  names of workers having the capability, be it with a
+                  version or not.
+                  In the third one, values are the :class:`frozenset` of
+                  names of workers having the capability with ``None``
+                  instead of versions.
+        """
+        index = {}
+        holders = {}
+        unversioned = {}
+        for workername, caps in self._worker_caps.items():
+            for cap, versions in caps.items():
+                cap = intern_string(cap)
+                holders.setdefault(cap, set()).add(workername)
+                if versions is None:
+                    unversioned.setdefault(cap, set()).add(workername)
+                    continue
+                by_version = index.setdefault(cap, {})
+                for version in versions:
+                    by_version.setdefault(intern_string(version),
+                                          set()).add(workername)
+        return (dict((cap, tuple((version, frozenset(names))
+                                 for version, names in by_version.items()))
+                     for cap, by_version in index.items()),
+                dict((cap, frozenset(workernames))
+                     for cap, workernames in holders.items()),
+                dict((cap, frozenset(workernames))
+                     for cap, workernames in unversioned.items()))
 
     def set_properties_make_environ(self, factory, cap_names):
         """Add property setting steps to factory and return environment vars.
@@ -152,14 +302,7 @@ class BuilderDispatcher(object):
                 name="props_" + cap_name,
                 capability_version_prop=capability.get('version_prop'),
             ))
-            to_env = capability.get('environ')
-            if not to_env:
-                continue
-            for env_key, interpolation in to_env.items():
-                def replace(m):
-                    return 'prop:' + CAPABILITY_PROP_FMT % (
-                        cap_name, m.group(1))
-                var = Interpolate(RE_PROP_CAP_OPT.sub(replace, interpolation))
+            for env_key, var in self._environ[cap_name].items():
                 if env_key == 'PATH':
                     var = [var, '${PATH}']
                 capability_env[env_key] = var
@@ -194,19 +337,71 @@ class BuilderDispatcher(object):
             base_conf['properties'] = dict(
                 build_requires=[str(req) for req in build_requires])
 
-        preconfs = [base_conf]
-        for version_filter in build_for:
+        # Dispatching with the most selective filters first keeps the
+        # intermediate combinations few. Selectivity is the number of
+        # matching versions, ties being broken by the kind of criteria.
+        # This does not change the final combinations, but builder names
+        # must then be made again to follow the order of build_for.
+        # If a capability appears several times, the last filter about it
+        # wins, hence the order matters and is kept.
+        build_for = list(build_for)
+        dispatched_caps = [vf.cap for vf in build_for]
+        # dispatching is lazy and stops early if a filter has no match:
+        # unknown capabilities must not go unnoticed because of that
+        for cap in dispatched_caps:
+            self.capabilities[cap]['version_prop']
+        if len(set(dispatched_caps)) == len(dispatched_caps):
+            ordered = sorted(build_for,
+                             key=lambda vf: (len(self.allowed_versions(vf)),
+                                             _criteria_weight(vf)))
+        else:
+            ordered = build_for
+        reordered = any(vf is not ovf for vf, ovf in zip(build_for, ordered))
+
+        preconfs = iter((base_conf, ))
+        for version_filter in ordered:
             preconfs = self.dispatch_builders_by_capability(
                 preconfs, version_filter)
 
         builders = []
         for conf in preconfs:
+            if reordered:
+                conf['name'] = self.builder_name(
+                    name, build_for, conf['properties'])
             conf.update(factory=factory, **kw)
             builders.append(util.BuilderConfig(**conf))
         return builders
 
+    def builder_name(self, name, build_for, properties):
+        """Return the name of a builder dispatched by capabilities.
+
+        :param name: base name for the builder
+        :param build_for: the iterable of `VersionFilter` instances used for
+                          dispatching
+        :param properties: the builder properties, holding the dispatched
+                           capability versions
+        """
+        for cap_vf in build_for:
+            cap = cap_vf.cap
+            name = '%s-%s%s' % (
+                name, self._abbrev[cap],
+                properties[self.capabilities[cap]['version_prop']])
+        return name
+
+    def allowed_versions(self, cap_vf):
+        """Return the available versions of a capability matching a filter.
+
+        :param cap_vf: capability version filter
+        :returns: a :class:`set` of version strings, as found in the
+                  workers capabilities.
+        """
+        return set(
+            version for version, _ in self._workers_by_cap_version.get(
+                cap_vf.cap, ())
+            if self.version_matches(cap_vf, version))
+
     def dispatch_builders_by_capability(self, builders, cap_vf):
-        """Take a list of builders parameters and redispatch by capability.
+        """Take builders parameters and lazily redispatch them by capability.
 
         :param builders: iterable of dicts with keywords arguments to create
                          ``BuilderConfig instances. These are not directly
@@ -230,61 +425,114 @@ class BuilderDispatcher(object):
         Of course the list of workers and properties are refined at each
         step. The idea is that only the latest such list will actually
         get registered.
+
+        :returns: a generator of refined builder parameters. Successive
+                  calls can therefore be chained without materializing
+                  the intermediate combinations.
         """
-        res = []
         cap = cap_vf.cap
         capdef = self.capabilities[cap]
         prop = capdef['version_prop']
-        abbrev = capdef.get('abbrev', cap)
+        abbrev = self._abbrev[cap]
+
+        # version filtering and name suffixes do not depend on the builder
+        suffixes = dict((version, '-%s%s' % (abbrev, version))
+                        for version in self.allowed_versions(cap_vf))
+        if not suffixes:
+            return
+
         for builder in builders:
             for cap_version, workernames in self.split_workers_by_capability(
                     cap, builder['workernames']).items():
 
-                if cap_vf is not None and not cap_vf.match(
-                        Version.parse(cap_version)):
+                suffix = suffixes.get(cap_version)
+                if suffix is None:
                     continue
 
-                refined = deepcopy(builder)
+                # a shallow copy is enough: only 'workernames' and
+                # 'properties' get refined, other values are shared
+                refined = builder.copy()
                 refined['workernames'] = workernames
-                refined.setdefault('properties', {})[prop] = cap_version
-                refined['name'] = '%s-%s%s' % (
-                    builder['name'], abbrev, cap_version)
-                res.append(refined)
-        return res
+                refined['properties'] = dict(builder.get('properties', ()))
+                refined['properties'][prop] = cap_version
+                refined['name'] = builder['name'] + suffix
+                yield refined
 
     def split_workers_by_capability(self, cap, workernames):
         """Organize an iterable of workernames into a dict capability versions.
 
         Each available version of the capability among the workers with given
         names is a key of the returned dict, and the corresponding value is the
-        list of those that have it.
+        list of those that have it, in the same order as in ``workernames``.
         """
         res = {}
-
-        for workername in workernames:
-            worker = self.all_workers[workername]
-            versions = worker.properties['capability'].get(cap)
-            if versions is None:
-                continue
-            for version in versions:
-                res.setdefault(version, []).append(workername)
+        workernames = list(workernames)
+        for version, holders in self._workers_by_cap_version.get(cap, ()):
+            having = [workername for workername in workernames
+                      if workername in holders]
+            if having:
+                res[version] = having
         return res
 
     def only_if_requires(self, worker):
-        """Shorcut for extraction of build-only-if-requires tokens."""
-        only = worker.properties.getProperty('build-only-if-requires')
-        return set(only.split()) if only is not None else set()
+        """Shorcut for extraction of build-only-if-requires tokens.
+
+        The result is cached per worker name, as worker properties are
+        static in the master configuration.
+        """
+        only_if = self._only_if_requires.get(worker.workername)
+        if only_if is None:
+            only = worker.properties.getProperty('build-only-if-requires')
+            only_if = frozenset(only.split() if only is not None else ())
+            self._only_if_requires[worker.workername] = only_if
+        return only_if
+
+    def workers_matching(self, req):
+        """Return the names of workers meeting a single requirement.
+
+        This is the set based counterpart of :func:`does_meet_requirements`,
+        relying on the capability index. Results are cached.
+
+        :param req: a :class:`VersionFilter` instance
+        :returns: a :class:`frozenset` of worker names
+        """
+        matching = self._workers_matching.get(req)
+        if matching is not None:
+            return matching
+
+        matching = set()
+        for version, workernames in self._workers_by_cap_version.get(
+                req.cap, ()):
+            if self.version_matches(req, version):
+                matching.update(workernames)
+        if self.version_matches(req, None):
+            matching.update(self._workers_without_versions.get(req.cap, ()))
+        matching = self._workers_matching[req] = frozenset(matching)
+        return matching
 
     def filter_workers_by_requires(self, requires):
         """Return an iterable of workernames meeting the requirements.
 
         The special ``build-only-if-requires`` worker attribute is taken into
         account.
+
+        Requirements are intersected starting with the capabilities that the
+        fewest workers have, so that the candidates set shrinks early.
         """
+        requires = sorted(
+            requires,
+            key=lambda req: len(self._workers_with_cap.get(req.cap, ())))
+        require_names = frozenset(req.cap for req in requires)
+
+        candidates = None
+        for req in requires:
+            matching = self.workers_matching(req)
+            candidates = (matching if candidates is None
+                          else candidates & matching)
+            if not candidates:
+                return []
 
-        require_names = set(req.cap for req in requires)
         return [workername
                 for workername, worker in self.all_workers.items()
-                if does_meet_requirements(
-                    worker.properties['capability'], requires) and
-                self.only_if_requires(worker).issubset(require_names)]
+                if (candidates is None or workername in candidates) and
+                self.only_if_requires(worker) <= require_names]
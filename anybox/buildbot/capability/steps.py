@@ -23,7 +23,7 @@ from buildbot.process.buildstep import SUCCESS
 from buildbot.process.buildstep import FAILURE  # NOQA
 
 from .constants import CAPABILITY_PROP_FMT
-from .version import Version, VersionFilter
+from .version import parse_version, VersionFilter
 
 
 class DescriptionBuildStep(LoggingBuildStep):
@@ -89,14 +89,14 @@ class SetCapabilityProperties(DescriptionBuildStep):
 
         logs = []
         # apply build_requires, if submitted
-        build_requires = self.getProperty(self.build_requires_prop, {})
-        for req in build_requires:
-            req = VersionFilter.parse(req)
-            if req.cap != self.capability_name:
-                continue
+        build_requires = [
+            req for req in (VersionFilter.parse(r) for r in
+                            self.getProperty(self.build_requires_prop, {}))
+            if req.cap == self.capability_name]
+        if build_requires:
             cap_details = dict(
                 (v, o) for (v, o) in cap_details.items()
-                if req.match(Version.parse(v)))
+                if all(req.match(parse_version(v)) for req in build_requires))
 
         options = None
         if self.capability_version_prop:
@@ -104,19 +104,23 @@ class SetCapabilityProperties(DescriptionBuildStep):
             if cap_version is not None:
                 options = cap_details[cap_version]
 
+        if options is None and len(cap_details) == 1:
+            options = next(iter(cap_details.values()))
+
         if options is None:
             # either we have no version property or it is not set
             # (can happen if several versions on this worker match the
             # requirement)
             # this is a peculiar case, but it can happen that a build
             # truly does not care about the version of the capability.
-            choice = random.choice(cap_details.keys())
+            versions = list(cap_details)
+            choice = random.choice(versions)
             logs.append("On worker %r, the following versions of capability %r "
                         "are applicable for this build: "
                         "%r, picking %r at random" % (
                             self.getProperty('workername'),
                             self.capability_name,
-                            cap_details.keys(),
+                            versions,
                             choice))
             options = cap_details[choice]
 
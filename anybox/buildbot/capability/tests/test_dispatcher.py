@@ -14,6 +14,7 @@
 #
 # Copyright Georges Racinet <gracinet@anybox.fr>
 
+import copy
 import unittest
 from ..dispatcher import BuilderDispatcher
 from ..version import Version, VersionFilter
@@ -36,15 +37,33 @@ CAPABILITIES = dict(
     without_env=dict(version_prop='wev', abbrev='we')
 )
 
+COMPILED_CAPABILITIES = BuilderDispatcher.compile_capabilities(CAPABILITIES)
 
-class FakeProperties(dict):
+
+class FakeProperties(object):
+
+    __slots__ = ('_props', )
+
+    def __init__(self):
+        self._props = {}
+
+    def __getitem__(self, k):
+        return self._props[k]
+
+    def __setitem__(self, k, v):
+        self._props[k] = v
+
+    def update(self, props):
+        self._props.update(props)
 
     def getProperty(self, k):
-        return self.get(k)
+        return self._props.get(k)
 
 
 class FakeWorker(object):
 
+    __slots__ = ('workername', 'properties')
+
     def __init__(self, name, props=None):
         self.workername = name
         self.properties = FakeProperties()
@@ -54,18 +73,45 @@ class FakeWorker(object):
 
 class DispatcherTestCase(unittest.TestCase):
 
+    # version filters common to several tests
+    PG_ANY = VersionFilter('postgresql', ())
+    PG_90 = VersionFilter('postgresql', ('==', Version(9, 0)))
+    PG_GT_90 = VersionFilter('postgresql', ('>', Version(9, 0)))
+    PG_84_TO_91 = VersionFilter('postgresql',
+                                ('AND',
+                                 ('>=', Version(8, 4)),
+                                 ('<=', Version(9, 1))))
+    PG_GT_90_OR_84 = VersionFilter('postgresql',
+                                   ('OR',
+                                    ('>', Version(9, 0)),
+                                    ('==', Version(8, 4))))
+    PY_ANY = VersionFilter('python', ())
+    PY_GE_26 = VersionFilter('python', ('>=', Version(2, 6)))
+    PY_LT_26 = VersionFilter('python', ('<', Version(2, 6)))
+    PRIVATE_CODE = VersionFilter('private-code-access', ())
+
+    def assertBuilderNames(self, builders, *names):
+        self.assertEqual(frozenset(builders), frozenset(names))
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pristine_factory = util.BuildFactory()
+
     def setUp(self):
-        self.factory = util.BuildFactory()
+        # a shallow copy shares the list of steps: tests needing to add
+        # steps must use their own factory (see test_capability_env)
+        self.factory = copy.copy(self.pristine_factory)
         self.make_workers()
         self.make_dispatcher()
 
     def make_dispatcher(self):
-        self.dispatcher = BuilderDispatcher(self.workers, CAPABILITIES)
+        self.dispatcher = BuilderDispatcher(self.workers, CAPABILITIES,
+                                            compiled=COMPILED_CAPABILITIES)
 
     def dispatch(self, **kw):
-        return dict((b.name, b)
-                    for b in self.dispatcher.make_builders(
-                            'bldr', self.factory, **kw))
+        return {b.name: b
+                for b in self.dispatcher.make_builders(
+                        'bldr', self.factory, **kw)}
 
 
 class TestDispatcherBuildFor(DispatcherTestCase):
@@ -89,7 +135,7 @@ class TestDispatcherBuildFor(DispatcherTestCase):
 
     def test_build_for_greater(self):
         builders = self.dispatch(
-            build_for=[VersionFilter('postgresql', ('>', Version(9, 0)))])
+            build_for=[self.PG_GT_90])
         self.assertEqual(builders.keys(), ['bldr-pg9.1-devel'])
 
     def test_build_for_unpresent(self):
@@ -98,58 +144,40 @@ class TestDispatcherBuildFor(DispatcherTestCase):
             capability={'python': {'2.7': {}}})))
         self.make_dispatcher()
         builders = self.dispatch(
-            build_for=[VersionFilter('postgresql', ('>', Version(9, 0)))])
+            build_for=[self.PG_GT_90])
         self.assertEqual(builders.keys(), ['bldr-pg9.1-devel'])
         self.assertEqual(builders['bldr-pg9.1-devel'].workernames,
                          ['w90-91'])
 
     def test_build_for_range(self):
         builders = self.dispatch(
-            build_for=[VersionFilter('postgresql',
-                                     ('AND',
-                                      ('>=', Version(8, 4)),
-                                      ('<=', Version(9, 1))))])
-        self.assertEqual(set(builders),
-                         set(('bldr-pg8.4',
-                              'bldr-pg9.0',
-                              'bldr-pg9.1-devel')))
+            build_for=[self.PG_84_TO_91])
+        self.assertBuilderNames(builders,
+                                'bldr-pg8.4',
+                                'bldr-pg9.0',
+                                'bldr-pg9.1-devel')
 
     def test_build_for_or_statement(self):
         builders = self.dispatch(
-            build_for=[VersionFilter('postgresql',
-                                     ('OR',
-                                      ('>', Version(9, 0)),
-                                      ('==', Version(8, 4))))])
-        self.assertEqual(set(builders),
-                         set(('bldr-pg8.4',
-                              'bldr-pg9.1-devel')))
+            build_for=[self.PG_GT_90_OR_84])
+        self.assertBuilderNames(builders, 'bldr-pg8.4', 'bldr-pg9.1-devel')
 
     def test_build_for2cap(self):
         """build_for dispatching for two capabilities."""
         builders = self.dispatch(
-            build_for=(VersionFilter('postgresql',
-                                     ('AND',
-                                      ('>=', Version(8, 4)),
-                                      ('<=', Version(9, 1)))),
-                       VersionFilter('python', ('>=', Version(2, 6))),
-                       ))
-        self.assertEqual(set(builders),
-                         set(('bldr-pg9.1-devel-py2.6',
-                              'bldr-pg9.0-py2.6')))
+            build_for=(self.PG_84_TO_91, self.PY_GE_26))
+        self.assertBuilderNames(builders,
+                                'bldr-pg9.1-devel-py2.6',
+                                'bldr-pg9.0-py2.6')
 
     def test_build_for2cap_more(self):
         """build_for dispatching for two capabilities, with more combinations"""
         builders = self.dispatch(
-            build_for=(VersionFilter('postgresql',
-                                     ('AND',
-                                      ('>=', Version(8, 4)),
-                                      ('<=', Version(9, 1)))),
-                       VersionFilter('python', ()),
-                       ))
-        self.assertEqual(set(builders),
-                         set(('bldr-pg9.1-devel-py2.6',
-                              'bldr-pg8.4-py2.4',
-                              'bldr-pg9.0-py2.6')))
+            build_for=(self.PG_84_TO_91, self.PY_ANY))
+        self.assertBuilderNames(builders,
+                                'bldr-pg9.1-devel-py2.6',
+                                'bldr-pg8.4-py2.4',
+                                'bldr-pg9.0-py2.6')
         self.assertEqual(
             builders['bldr-pg9.0-py2.6'].properties,
             dict(pg_version='9.0', py_version='2.6'))
@@ -163,12 +191,7 @@ class TestDispatcherBuildFor(DispatcherTestCase):
     def test_build_for2cap_or(self):
         """build_for dispatching for two capabilities with OR, one solution"""
         builders = self.dispatch(
-            build_for=(VersionFilter('postgresql',
-                                     ('OR',
-                                      ('>', Version(9, 0)),
-                                      ('==', Version(8, 4)))),
-                       VersionFilter('python', ('<', Version(2, 6))),
-                       ))
+            build_for=(self.PG_GT_90_OR_84, self.PY_LT_26))
         self.assertEqual(builders.keys(), ['bldr-pg8.4-py2.4'])
 
     def test_build_for_2cap_2(self):
@@ -182,18 +205,12 @@ class TestDispatcherBuildFor(DispatcherTestCase):
         self.make_dispatcher()
 
         builders = self.dispatch(
-            build_for=(VersionFilter('postgresql',
-                                     ('AND',
-                                      ('>=', Version(8, 4)),
-                                      ('<=', Version(9, 1)))),
-                       VersionFilter('python', ('>=', Version(2, 6))),
-                       ))
-
-        self.assertEqual(set(builders),
-                         set(('bldr-pg9.0-py2.6',
-                              'bldr-pg9.0-py2.7',
-                              'bldr-pg9.1-devel-py2.6',
-                              )))
+            build_for=(self.PG_84_TO_91, self.PY_GE_26))
+
+        self.assertBuilderNames(builders,
+                                'bldr-pg9.0-py2.6',
+                                'bldr-pg9.0-py2.7',
+                                'bldr-pg9.1-devel-py2.6')
 
         self.assertEqual(
             self.dispatch(
@@ -201,17 +218,41 @@ class TestDispatcherBuildFor(DispatcherTestCase):
                                          ('OR',
                                           ('==', Version(8, 4)),
                                           ('>', Version(9, 0)))),
-                           VersionFilter('python', ('<', Version(2, 6))),
+                           self.PY_LT_26,
                            )),
             {})
 
         self.assertEqual(
             self.dispatch(
-                build_for=(VersionFilter('postgresql', ('>', Version(9, 0))),
+                build_for=(self.PG_GT_90,
                            VersionFilter('python', ('==', Version(2, 7)))),
                            ),
             {})
 
+    def test_build_for_repeated_cap(self):
+        """Order of build_for is kept if a capability appears several times.
+
+        The last filter about the capability gives the version.
+        """
+        self.workers = [FakeWorker('w84-90-91', props=dict(
+            capability={'postgresql': {'8.4': {}, '9.0': {}, '9.1': {}}}))]
+        self.make_dispatcher()
+        builders = self.dispatch(
+            build_for=(self.PG_ANY, VersionFilter.parse('postgresql >= 9.1')))
+        self.assertBuilderNames(builders,
+                                'bldr-pg8.4-pg9.1',
+                                'bldr-pg9.0-pg9.1',
+                                'bldr-pg9.1-pg9.1')
+        for builder in builders.values():
+            self.assertEqual(builder.properties, dict(pg_version='9.1'))
+
+    def test_build_for_unknown_cap(self):
+        """An unknown capability is an error, even after an empty match."""
+        self.make_dispatcher()
+        self.assertRaises(KeyError, self.dispatch,
+                          build_for=(VersionFilter.parse('postgresql > 100'),
+                                     VersionFilter.parse('typo == 1')))
+
 
 class TestDispatcherBuildRequires(DispatcherTestCase):
 
@@ -246,12 +287,10 @@ class TestDispatcherBuildRequires(DispatcherTestCase):
 
     def test_build_requires_for_all_versions(self):
         builders = self.dispatch(
-            build_requires=[VersionFilter('private-code-access', ())],
-            build_for=[VersionFilter('postgresql', ())],
+            build_requires=[self.PRIVATE_CODE],
+            build_for=[self.PG_ANY],
         )
-        self.assertEqual(set(builders),
-                         set(('bldr-pg8.4',
-                              'bldr-pg9.1-devel',)))
+        self.assertBuilderNames(builders, 'bldr-pg8.4', 'bldr-pg9.1-devel')
         self.assertEqual(builders['bldr-pg8.4'].workernames,
                          ['privcode', 'privcode-84'])
         self.assertEqual(builders['bldr-pg9.1-devel'].workernames,
@@ -259,8 +298,8 @@ class TestDispatcherBuildRequires(DispatcherTestCase):
 
     def test_build_requires_for_restrictive(self):
         builders = self.dispatch(
-            build_requires=[VersionFilter('private-code-access', ())],
-            build_for=[VersionFilter('postgresql', ('>', Version(9, 0)))],
+            build_requires=[self.PRIVATE_CODE],
+            build_for=[self.PG_GT_90],
         )
         self.assertEqual(builders.keys(), ['bldr-pg9.1-devel'])
         self.assertEqual(builders['bldr-pg9.1-devel'].workernames,
@@ -270,7 +309,7 @@ class TestDispatcherBuildRequires(DispatcherTestCase):
         rabbit_vf = VersionFilter('rabbitmq', ('>=', Version(2, 0)))
         builders = self.dispatch(
             build_requires=[rabbit_vf],
-            build_for=[VersionFilter('postgresql', ('==', Version(9, 0)))],
+            build_for=[self.PG_90],
         )
         self.assertEqual(builders.keys(), ['bldr-pg9.0'])
         builder = builders['bldr-pg9.0']
@@ -287,7 +326,7 @@ class TestDispatcherBuildRequires(DispatcherTestCase):
         rabbit_vf = VersionFilter('rabbitmq', ('==', Version(1, 8)))
         builders = self.dispatch(
             build_requires=[rabbit_vf],
-            build_for=[VersionFilter('postgresql', ('==', Version(9, 0)))],
+            build_for=[self.PG_90],
         )
         self.assertEqual(builders.keys(), ['bldr-pg9.0'])
         self.assertEqual(builders['bldr-pg9.0'].workernames, ['rabb18'])
@@ -301,6 +340,21 @@ class TestDispatcherBuildRequires(DispatcherTestCase):
         self.make_dispatcher()
         self.test_build_requires_2()
 
+    def test_build_requires_empty_on_worker(self):
+        """A capability without any version or None does not meet reqs."""
+        self.workers.append(
+            FakeWorker('emptyrabb', props=dict(
+                capability={'rabbitmq': {},
+                            'postgresql': {'9.0': {'port': 5434}}
+                            })))
+        self.make_dispatcher()
+        builders = self.dispatch(
+            build_requires=[VersionFilter('rabbitmq', ())],
+            build_for=[self.PG_90],
+        )
+        self.assertEqual(set(builders['bldr-pg9.0'].workernames),
+                         set(('rabb284', 'rabb18')))
+
     def test_build_requires_no_match(self):
         builders = self.dispatch(
             build_requires=[VersionFilter('rabbitmq', ('==', Version(1, 9)))],
@@ -310,7 +364,7 @@ class TestDispatcherBuildRequires(DispatcherTestCase):
     def test_build_requires_only_if(self):
         self.workers[0].properties['build-only-if-requires'] = 'private-code-access'
         builders = self.dispatch(
-            build_for=[VersionFilter('postgresql', ('>', Version(9, 0)))],
+            build_for=[self.PG_GT_90],
         )
         self.assertEqual(builders.keys(), ['bldr-pg9.1-devel'])
         # does not run on 'privcode' worker, since the 'private-code-access'
@@ -318,6 +372,27 @@ class TestDispatcherBuildRequires(DispatcherTestCase):
         self.assertEqual(builders['bldr-pg9.1-devel'].workernames,
                          ['privcode-91', 'pg90-91'])
 
+    def test_invalidate(self):
+        self.dispatch(
+            build_for=[self.PG_GT_90])
+        props = self.workers[0].properties
+        props['build-only-if-requires'] = 'private-code-access'
+        props['capability']['postgresql']['9.2'] = {}
+        self.dispatcher.invalidate()
+        builders = self.dispatch(
+            build_for=[self.PG_GT_90],
+        )
+        self.assertBuilderNames(builders, 'bldr-pg9.1-devel')
+        self.assertEqual(builders['bldr-pg9.1-devel'].workernames,
+                         ['privcode-91', 'pg90-91'])
+
+        builders = self.dispatch(
+            build_requires=[self.PRIVATE_CODE],
+            build_for=[self.PG_GT_90],
+        )
+        self.assertBuilderNames(builders, 'bldr-pg9.1-devel', 'bldr-pg9.2')
+        self.assertEqual(builders['bldr-pg9.2'].workernames, ['privcode'])
+
 
 class TestDispatcherEnviron(DispatcherTestCase):
 
@@ -345,8 +420,8 @@ class TestDispatcherEnviron(DispatcherTestCase):
                          [util.Interpolate('%(prop:cap_postgresql_bin:-)s'),
                           '${PATH}'])
 
-        steps = dict((s.kwargs['name'], s) for s in factory.steps
-                     if s.factory is SetCapabilityProperties)
+        steps = {s.kwargs['name']: s for s in factory.steps
+                 if s.factory is SetCapabilityProperties}
 
         self.assertTrue('props_python' in steps)
         prop_step = steps['props_python']
@@ -364,3 +439,7 @@ class TestDispatcherEnviron(DispatcherTestCase):
         prop_step = steps['props_without_env']
         self.assertEquals(prop_step.args, ('without_env',))
         self.assertEquals(prop_step.kwargs['capability_version_prop'], 'wev')
+
+    def test_capability_env_not_compiled(self):
+        self.dispatcher = BuilderDispatcher(self.workers, CAPABILITIES)
+        self.test_capability_env()
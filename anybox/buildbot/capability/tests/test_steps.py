@@ -61,6 +61,9 @@ class TestSetCapabilityProperties(unittest.TestCase):
         self.assertEqual(
             step.getProperty(CAPABILITY_PROP_FMT % ('zecap', 'bin')),
             '/usr/bin/zecap')
+        # the only version is not a random choice
+        log_name, log_text = self.log
+        self.assertFalse('at random' in log_text)
 
     def test_no_details(self):
         step = self.step
@@ -109,6 +112,21 @@ class TestSetCapabilityProperties(unittest.TestCase):
             step.getProperty(CAPABILITY_PROP_FMT % ('zecap', 'bin')),
             '/usr/bin/zecap1')
 
+    def test_several_requirements_same_cap(self):
+        step = self.step
+        step.setProperty('capability',
+                         dict(zecap={'0.5': dict(bin='/usr/bin/zecap0'),
+                                     '1.0': dict(bin='/usr/bin/zecap1'),
+                                     '2.0': dict(bin='/usr/bin/zecap2'),
+                                     },
+                              ), 'BuildSlave')
+        step.setProperty('build_requires', ["zecap >= 1", "zecap < 2"])
+        step.start()
+        self.assertEqual(self.step_status, SUCCESS)
+        self.assertEqual(
+            step.getProperty(CAPABILITY_PROP_FMT % ('zecap', 'bin')),
+            '/usr/bin/zecap1')
+
     def test_several_meeting_requirements(self):
         step = self.step
         step.setProperty('capability',
@@ -14,6 +14,26 @@
 #
 # Copyright Georges Racinet <gracinet@anybox.fr>
 
+import operator
+from weakref import WeakValueDictionary
+try:
+    from sys import intern
+except ImportError:  # Python 2, where it is a builtin
+    pass
+
+
+def intern_string(value):
+    """Intern native strings, return anything else (None, unicode) as is.
+
+    Capability names and versions are used over and over as dict keys.
+
+    >>> intern_string('post' + 'gresql') is intern_string('postgresql')
+    True
+    >>> intern_string(None) is None
+    True
+    """
+    return intern(value) if type(value) is str else value
+
 
 class VersionParseError(ValueError):
     """Dedicated exception for version and version filter parsing errors.
@@ -63,8 +83,19 @@ class Version(object):
 
     >>> try: v = Version(9, 1, prefix='devel')
     ... except ValueError: pass
+
+    Versions can be pickled, whatever the protocol::
+
+    >>> import pickle
+    >>> v = Version(9, 2, suffix='devel')
+    >>> all(pickle.loads(pickle.dumps(v, protocol)) == v
+    ...     for protocol in range(pickle.HIGHEST_PROTOCOL + 1))
+    True
     """
 
+    # comparisons are the inner loop of version filtering
+    __slots__ = ('version', 'suffix')
+
     def __init__(self, *version, **kw):
         self.version = version
         self.suffix = None
@@ -73,6 +104,13 @@ class Version(object):
                 raise ValueError("Unaccepted Version option %r=%r" % (k, v))
             self.suffix = v
 
+    def __getstate__(self):
+        # needed by pickle protocols < 2, because of __slots__
+        return self.version, self.suffix
+
+    def __setstate__(self, state):
+        self.version, self.suffix = state
+
     def __repr__(self):
         numeric = (', '.join([str(v) for v in self.version]))
         if self.suffix is None:
@@ -88,6 +126,12 @@ class Version(object):
     def __eq__(self, other):
         return self.version == other.version and self.suffix == other.suffix
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.version, self.suffix))
+
     def __gt__(self, other):
         if self.version == other.version:
             return other.suffix == 'devel' and self.suffix is None
@@ -152,6 +196,42 @@ class Version(object):
         return cls(*version, **kw)
 
 
+_parsed_versions = {}
+
+
+def parse_version(as_string):
+    """Memoized :meth:`Version.parse`.
+
+    Capability versions are few, but mentioned by many workers, builders and
+    build requirements. Returned instances are shared, and must not be
+    modified.
+
+    >>> parse_version('9.1')
+    Version(9, 1)
+    >>> parse_version('9.1') is parse_version('9.1')
+    True
+    >>> parse_version(None) is None
+    True
+    """
+    try:
+        return _parsed_versions[as_string]
+    except KeyError:
+        version = _parsed_versions[as_string] = Version.parse(as_string)
+        return version
+
+
+_unary_ops = {'>=': operator.ge,
+              '==': operator.eq,
+              '<=': operator.le,
+              '<': operator.lt,
+              '>': operator.gt,
+              }
+
+
+def _always(version):
+    return True
+
+
 class VersionFilter(object):
     """Represent a simple version filter.
 
@@ -206,17 +286,50 @@ class VersionFilter(object):
 
       >>> repr(VersionFilter.parse('pg >= 9 < 9.3'))
       "VersionFilter('pg', ('AND', ('>=', Version(9)), ('<', Version(9, 3))))"
+
+    Version filters are hashable, equal ones having the same hash, so that
+    they can be used as cache keys::
+
+      >>> vf = VersionFilter('pg', ('>=', Version(9, 1)))
+      >>> {vf: True}[VersionFilter.parse('pg >= 9.1')]
+      True
+
+    Version filters must be considered immutable: the matching function and
+    string form are computed from the criteria once and for all, and parsed
+    instances are shared (see :meth:`parse`).
+
+    They can be pickled nonetheless::
+
+      >>> import pickle
+      >>> vf = pickle.loads(pickle.dumps(VersionFilter.parse('pg >= 9.1')))
+      >>> vf.match(Version(9, 2)), str(vf)
+      (True, 'pg >= 9.1')
     """
 
     def __init__(self, capability, criteria):
         """Init with name from a parsed list of criteria."""
 
-        self.cap = capability
+        self.cap = intern_string(capability)
         self.criteria = tuple(criteria)
+        self._str = None
+        self._match = self.make_matcher(self.criteria) if criteria else None
+
+    def __getstate__(self):
+        # the matching function is made of closures, that can't be pickled
+        return self.cap, self.criteria
+
+    def __setstate__(self, state):
+        self.__init__(*state)
 
     def __eq__(self, other):
         return (self.cap, self.criteria) == (other.cap, other.criteria)
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.cap, self.criteria))
+
     def match(self, version):
         """Tell if the given version matches the criteria."""
 
@@ -224,7 +337,7 @@ class VersionFilter(object):
             return True
         if version is None:
             return False
-        return self.boolean_match(version, self.criteria)
+        return self._match(version)
 
     def __repr__(self):
         return 'VersionFilter(%r, %r)' % (self.cap, self.criteria)
@@ -239,9 +352,15 @@ class VersionFilter(object):
         return ' '.join((op, str(crit[1])))
 
     def __str__(self):
-        if not self.criteria:
-            return self.cap
-        return ' '.join((self.cap, self._crit_str(self.criteria)))
+        # computed once: the string form is used as a property value and
+        # as a cache key by the dispatcher
+        if self._str is None:
+            if not self.criteria:
+                self._str = self.cap
+            else:
+                self._str = ' '.join((self.cap,
+                                      self._crit_str(self.criteria)))
+        return self._str
 
     @classmethod
     def boolean_parse(cls, reqline):
@@ -260,6 +379,37 @@ class VersionFilter(object):
 
         return 'AND', vreq, cls.boolean_parse(split[2])
 
+    @classmethod
+    def make_matcher(cls, criteria):
+        """Turn criteria into a function telling if a version matches.
+
+        This gives the same results as :meth:`boolean_match`, without
+        walking through the criteria at each call.
+
+        >>> matcher = VersionFilter.make_matcher(
+        ...     ('OR', ('AND', ('>=', Version(8, 4)), ('<', Version(9))),
+        ...      ('==', Version(9, 2))))
+        >>> [matcher(Version(*v)) for v in ((8, 4), (9, 1), (9, 2))]
+        [True, False, True]
+        """
+        op = criteria[0]
+
+        # binary ops
+        if op.upper() in ('AND', 'OR'):
+            left = cls.make_matcher(criteria[1])
+            right = cls.make_matcher(criteria[2])
+            if op.upper() == 'OR':
+                return lambda version: left(version) or right(version)
+            return lambda version: left(version) and right(version)
+
+        # unary ops
+        compare = _unary_ops.get(op)
+        if compare is None:
+            # unknown operators don't exclude anything in boolean_match()
+            return _always
+        crit_version = criteria[1]
+        return lambda version: compare(version, crit_version)
+
     def boolean_match(self, version, criteria):
         op = criteria[0]
 
@@ -293,9 +443,25 @@ class VersionFilter(object):
         ...            ('AND', ('<=', Version(9, 2)), ('>', Version(8, 4))),
         ...            ('==', Version(8, 4, suffix='patched'))))
         True
+
+        Parsed filters are interned, as long as they are in use:
+
+        >>> vf = VersionFilter.parse('postgresql >= 9.2')
+        >>> VersionFilter.parse('postgresql >= 9.2') is vf
+        True
         """
+        interned = _parsed_filters.get((cls, as_string))
+        if interned is not None:
+            return interned
+
         split = as_string.split(' ', 1)
         cap = split[0]
         if len(split) == 1:
-            return cls(split[0], ())
-        return cls(cap, cls.boolean_parse(split[1]))
+            vf = cls(split[0], ())
+        else:
+            vf = cls(cap, cls.boolean_parse(split[1]))
+        _parsed_filters[cls, as_string] = vf
+        return vf
+
+
+_parsed_filters = WeakValueDictionary()
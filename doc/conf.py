@@ -54,10 +54,16 @@ copyright = u'2016, Georges Racinet'
 # |version| and |release|, also used in various other places throughout the
 # built documents.
 #
-# The short X.Y version.
-version = '1.0'
 # The full version, including alpha/beta/rc tags.
-release = '1.0'
+version_info = {}
+version_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'anybox', 'buildbot', 'capability',
+                            '_version.py')
+with open(version_path) as version_file:
+    exec(compile(version_file.read(), version_path, 'exec'), version_info)
+release = version_info['__version__']
+# The short X.Y version.
+version = '.'.join(release.split('.')[:2])
 
 # The language for content autogenerated by Sphinx. Refer to documentation
 # for a list of supported languages.
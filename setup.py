@@ -14,44 +14,66 @@
 #
 # Copyright Georges Racinet <gracinet@anybox.fr>
 
-from setuptools import setup, find_packages
+import os
+from setuptools import setup
 
-version = '0.2'
 pkg_name = "anybox.buildbot.capability"
+here = os.path.dirname(__file__)
 
+# importing the package would require its dependencies
+version_info = {}
+version_path = os.path.join(here, 'anybox', 'buildbot', 'capability',
+                            '_version.py')
+with open(version_path) as version_file:
+    exec(compile(version_file.read(), version_path, 'exec'), version_info)
+version = version_info['__version__']
 
-def steps_ep(step_names):
-    return ["%s = anybox.buildbot.capability.steps:%s" % (name, name)
-            for name in step_names]
+try:
+    with open(os.path.join(here, 'README.rst')) as readme:
+        long_description = readme.read()
+except IOError:
+    # e.g., source distributions made without the README
+    long_description = ''
 
-setup(
-    name=pkg_name,
-    version=version,
-    author="Anybox SAS",
-    author_email="gracinet@anybox.fr",
-    description="Static capability system for buildbot",
-    license="GPLv2+",
-    long_description=open('README.rst').read(),
-    url="http://pypi.python.org/pypi/anybox.buildbot.capability",
-    packages=find_packages(),
-    zip_safe=False,
-    include_package_data=True,
-    namespace_packages=['anybox', 'anybox.buildbot'],
-    install_requires=['buildbot',
-                      ],
-    tests_require=['nose'],
-    test_suite='nose.collector',
-    classifiers=[
-        'Intended Audience :: Developers',
-        'Intended Audience :: System Administrators',
-        'Topic :: Software Development :: Build Tools',
-        'Topic :: Software Development :: Testing',
-        'Topic :: Software Development :: Quality Assurance',
-        'Topic :: Software Development :: Libraries :: Python Modules',
-        'License :: OSI Approved :: GNU General Public License v2 '
-        'or later (GPLv2+)',
-    ],
-    entry_points={
-        'buildbot.steps': steps_ep(('SetCapabilityProperties', ))
-    }
+CLASSIFIERS = (
+    'Intended Audience :: Developers',
+    'Intended Audience :: System Administrators',
+    'Topic :: Software Development :: Build Tools',
+    'Topic :: Software Development :: Testing',
+    'Topic :: Software Development :: Quality Assurance',
+    'Topic :: Software Development :: Libraries :: Python Modules',
+    'License :: OSI Approved :: GNU General Public License v2 '
+    'or later (GPLv2+)',
 )
+
+INSTALL_REQUIRES = ['buildbot >= 0.9.0b1']
+
+# importing this module (e.g., from static metadata tools) must not run setup
+if __name__ == '__main__':
+    setup(
+        name=pkg_name,
+        version=version,
+        author="Anybox SAS",
+        author_email="gracinet@anybox.fr",
+        description="Static capability system for buildbot",
+        license="GPLv2+",
+        long_description=long_description,
+        url="http://pypi.python.org/pypi/anybox.buildbot.capability",
+        packages=['anybox',
+                  'anybox.buildbot',
+                  'anybox.buildbot.capability',
+                  'anybox.buildbot.capability.tests',
+                  ],
+        zip_safe=False,
+        include_package_data=True,
+        install_requires=INSTALL_REQUIRES,
+        extras_require={'test': ['nose']},
+        # distutils expects a list
+        classifiers=list(CLASSIFIERS),
+        entry_points={
+            'buildbot.steps': [
+                'SetCapabilityProperties = '
+                'anybox.buildbot.capability.steps:SetCapabilityProperties',
+            ],
+        }
+    )